@@ -1,14 +1,25 @@
 import os
+import re
+import sys
 import csv
-import json
 import time
+import queue
 import shlex
+import atexit
+import signal
 import asyncio
+import hashlib
+import threading
 import datetime as dt
 from pathlib import Path
-from concurrent.futures import ThreadPoolExecutor
-from flask import Flask, request, jsonify
+from collections import deque, OrderedDict
+from contextlib import contextmanager, nullcontext
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FuturesTimeout
+from flask import Flask, Response, request, jsonify
+from flask.json.provider import JSONProvider
 from flask_cors import CORS
+import orjson
+from cachetools import TTLCache
 
 # ---- Database (MariaDB) ----
 DB_HOST = os.getenv("DB_HOST", "localhost")
@@ -16,12 +27,18 @@ DB_PORT = int(os.getenv("DB_PORT", "3306"))
 DB_USER = os.getenv("DB_USER", "chatuser")
 DB_PASS = os.getenv("DB_PASS", "strongpassword")
 DB_NAME = os.getenv("DB_NAME", "chatbot")
+DB_POOL_MIN = int(os.getenv("DB_POOL_MIN", "5"))
+DB_POOL_MAX = int(os.getenv("DB_POOL_MAX", "20"))
+
+def _new_db_pool():
+    from dbpool import DBPool
+    return DBPool(min_size=DB_POOL_MIN, max_size=DB_POOL_MAX,
+                  host=DB_HOST, port=DB_PORT, user=DB_USER, password=DB_PASS, database=DB_NAME)
 
 USE_DB = True
 try:
-    import pymysql
-    db_conn = pymysql.connect(host=DB_HOST, port=DB_PORT, user=DB_USER, password=DB_PASS, database=DB_NAME, autocommit=True)
-    with db_conn.cursor() as cur:
+    db_pool = _new_db_pool()
+    with db_pool.connection() as c, c.cursor() as cur:
         cur.execute("""
             CREATE TABLE IF NOT EXISTS conversations (
                 id INT AUTO_INCREMENT PRIMARY KEY,
@@ -32,19 +49,28 @@ try:
                 timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
             ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
         """)
+        # history reads are WHERE session_id ORDER BY id: serve them from an index range scan
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_sess_id ON conversations (session_id, id)")
     print("[DB] Connected.")
 except Exception as e:
     print("[DB] Disabled (", e, ")")
     USE_DB = False
-    db_conn = None
+    db_pool = None
+
+@contextmanager
+def get_conn():
+    # lease a pooled connection for the duration of one unit of work
+    with db_pool.connection() as conn:
+        yield conn
 
 # ---- Files / Datasets ----
 DATASET_DIR = Path(os.getenv("DATASET_DIR", "/var/www/htdocs/datasets"))
 DATASET_DIR.mkdir(parents=True, exist_ok=True)
 
 # ---- Providers and tgpt ----
-VALID_PROVIDERS = ["pollinations", "sky", "phind", "koboldai", "kimi"]
-GROUP_LIST = VALID_PROVIDERS[:]  # group = all listed
+VALID_PROVIDERS_TUPLE = ("pollinations", "sky", "phind", "koboldai", "kimi")  # ordered
+VALID_PROVIDERS = frozenset(VALID_PROVIDERS_TUPLE)  # membership checks
+GROUP_LIST = list(VALID_PROVIDERS_TUPLE)  # group = all listed
 
 TGPT_BIN = os.getenv("TGPT_BIN", "tgpt")
 TGPT_TIMEOUT = int(os.getenv("TGPT_TIMEOUT", "75"))  # seconds
@@ -52,154 +78,591 @@ TGPT_TIMEOUT = int(os.getenv("TGPT_TIMEOUT", "75"))  # seconds
 def _now_str():
     return dt.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
 
-def save_to_db(session_id: str, provider: str, message: str, mtype: str):
-    if not USE_DB: return
+DB_BATCH_ROWS = 500  # rows per INSERT, keeps each statement well under max_allowed_packet
+
+def save_many_to_db(session_id: str, rows):
+    # rows: list of (provider, message, type, timestamp); one multi-VALUES INSERT per chunk
+    if not USE_DB or not rows: return
     try:
-        with db_conn.cursor() as cur:
-            cur.execute(
-                "INSERT INTO conversations (session_id, provider, message, type, timestamp) VALUES (%s,%s,%s,%s,%s)",
-                (session_id, provider, message, mtype, _now_str())
-            )
+        # the session's dialog lock makes insert + cache update atomic against a cold load;
+        # with the cache off there is nothing to protect, so inserts don't serialize
+        lock = _dialog_session_lock(session_id) if DIALOG_CACHE else nullcontext()
+        with lock, get_conn() as c, c.cursor() as cur:
+            for i in range(0, len(rows), DB_BATCH_ROWS):
+                chunk = rows[i:i+DB_BATCH_ROWS]
+                sql = ("INSERT INTO conversations (session_id, provider, message, type, timestamp) VALUES "
+                       + ",".join(["(%s,%s,%s,%s,%s)"] * len(chunk)))
+                params = []
+                for provider, message, mtype, ts in chunk:
+                    params.extend((session_id, provider, message, mtype, ts))
+                cur.execute(sql, tuple(params))
+            _remember_dialog(session_id, rows)
     except Exception as e:
-        print("[DB] insert failed:", e)
+        print("[DB] batch insert failed:", e)
+
+# raw TIMESTAMP comes back as datetime; formatting happens here instead of per row in SQL
+HISTORY_SQL = "SELECT provider, message, timestamp FROM conversations WHERE session_id=%s ORDER BY id ASC LIMIT %s"
+
+def _ts_str(ts):
+    return ts.strftime("%Y-%m-%d %H:%M:%S") if isinstance(ts, dt.datetime) else ts
 
 def fetch_history(session_id: str, limit: int = 500):
     if not USE_DB: return []
     try:
-        with db_conn.cursor() as cur:
-            cur.execute(
-                "SELECT provider, message, DATE_FORMAT(timestamp,'%%Y-%%m-%%d %%H:%%i:%%s') FROM conversations WHERE session_id=%s ORDER BY id ASC LIMIT %s",
-                (session_id, limit)
-            )
+        with get_conn() as c, c.cursor() as cur:
+            cur.execute(HISTORY_SQL, (session_id, limit))
             rows = cur.fetchall()
-            return [{"provider": r[0], "message": r[1], "timestamp": r[2]} for r in rows]
+            return [{"provider": r[0], "message": r[1], "timestamp": _ts_str(r[2])} for r in rows]
     except Exception as e:
         print("[DB] history failed:", e)
         return []
 
+# newest rows first in the subquery, returned oldest-first: a rolling window like the deque
+RECENT_DIALOG_SQL = ("SELECT provider, message, timestamp FROM ("
+                     "SELECT id, provider, message, timestamp FROM conversations "
+                     "WHERE session_id=%s ORDER BY id DESC LIMIT %s) t ORDER BY id ASC")
+
+def fetch_recent_dialog(session_id: str, limit: int):
+    # None on error, so callers can tell "no rows" from "couldn't read"
+    try:
+        with get_conn() as c, c.cursor() as cur:
+            cur.execute(RECENT_DIALOG_SQL, (session_id, limit))
+            return [{"provider": r[0], "message": r[1], "timestamp": _ts_str(r[2])} for r in cur.fetchall()]
+    except Exception as e:
+        print("[DB] dialog failed:", e)
+        return None
+
+# Rolling per-session dialog for dataset "dialog" snapshots, so /ask and /brainstorm don't
+# re-read up to 500 rows after every insert. A snapshot is the newest DIALOG_MAX rows, with
+# or without the cache. A session is loaded from the DB on first use,
+# then kept current by save_many_to_db; clear_history drops it, and only the
+# DIALOG_SESSIONS most recently used sessions are kept.
+#
+# The cache only sees this process's inserts, so it is correct with a single worker only.
+# DIALOG_CACHE=0 reads every snapshot from the DB instead; wsgi.py defaults to that because
+# the documented gunicorn setup runs several workers.
+DIALOG_CACHE = os.getenv("DIALOG_CACHE", "1") == "1"
+DIALOG_MAX = 500
+DIALOG_SESSIONS = int(os.getenv("DIALOG_SESSIONS", "256"))
+SESSION_DIALOG = OrderedDict()  # session_id -> deque of rows, LRU order
+dialog_lock = threading.Lock()
+# striped per-session locks: a cold load and an insert for the same session never overlap,
+# so a row can't land between the SELECT and the cache fill and go missing
+_dialog_stripes = [threading.Lock() for _ in range(64)]
+
+def _dialog_session_lock(session_id: str):
+    return _dialog_stripes[hash(session_id) % len(_dialog_stripes)]
+
+def _remember_dialog(session_id: str, rows):
+    with dialog_lock:
+        d = SESSION_DIALOG.get(session_id)
+        if d is not None:
+            d.extend({"provider": p, "message": m, "timestamp": ts} for p, m, _, ts in rows)
+
+def session_dialog(session_id: str):
+    if not DIALOG_CACHE:
+        return fetch_recent_dialog(session_id, DIALOG_MAX) or []
+    with dialog_lock:
+        d = SESSION_DIALOG.get(session_id)
+        if d is not None:
+            SESSION_DIALOG.move_to_end(session_id)
+            return list(d)
+    with _dialog_session_lock(session_id):
+        with dialog_lock:
+            d = SESSION_DIALOG.get(session_id)
+        if d is None:
+            rows = fetch_recent_dialog(session_id, DIALOG_MAX)
+            if rows is None:
+                return []  # DB error: don't cache, retry on the next snapshot
+            d = deque(rows, maxlen=DIALOG_MAX)
+            with dialog_lock:
+                SESSION_DIALOG[session_id] = d
+                while len(SESSION_DIALOG) > DIALOG_SESSIONS:
+                    SESSION_DIALOG.popitem(last=False)
+        with dialog_lock:
+            return list(d)
+
+def forget_dialog(session_id: str):
+    with dialog_lock:
+        SESSION_DIALOG.pop(session_id, None)
+
 def dataset_path(filename: str, fmt: str):
     safe_name = (filename or f"dataset_{int(time.time())}").strip().replace("/", "_")
     ext = ".csv" if fmt == "csv" else ".json"
     return DATASET_DIR / f"{safe_name}{ext}"
 
-def append_dataset_lines(fp: Path, session_id: str, fmt: str, entries):
+# Dataset files stay open between flushes: one handle + lock per path, the CSV header
+# written exactly once when the handle is first opened on an empty file (no exists()/stat
+# race between writers). Least recently used handles are closed past DATASET_MAX_OPEN.
+# The header check and every write also hold an fcntl.flock on the file, so several
+# gunicorn workers appending to the same dataset neither double the header nor interleave
+# rows. Without fcntl (Windows) these guarantees hold within one process only.
+DATASET_MAX_OPEN = int(os.getenv("DATASET_MAX_OPEN", "64"))
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+@contextmanager
+def _flocked(fh):
+    if fcntl is None:
+        yield
+        return
+    fcntl.flock(fh.fileno(), fcntl.LOCK_EX)
+    try:
+        yield
+    finally:
+        fcntl.flock(fh.fileno(), fcntl.LOCK_UN)
+
+class _DatasetFile:
+    __slots__ = ("fh", "lock")
+
+    def __init__(self, fh):
+        self.fh = fh
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def writing(self):
+        # thread lock for this process, flock for other processes; callers flush inside
+        with self.lock, _flocked(self.fh):
+            yield self.fh
+
+FILES = OrderedDict()  # Path -> _DatasetFile
+files_lock = threading.Lock()
+
+def _dataset_file(fp: Path, binary: bool, header=None):
+    with files_lock:
+        entry = FILES.get(fp)
+        if entry is not None:
+            FILES.move_to_end(fp)
+            return entry
+        fh = fp.open("ab") if binary else fp.open("a", encoding="utf-8", newline="")
+        if header:
+            with _flocked(fh):
+                if os.fstat(fh.fileno()).st_size == 0:
+                    csv.writer(fh).writerow(header)
+                    fh.flush()
+        entry = FILES[fp] = _DatasetFile(fh)
+        while len(FILES) > DATASET_MAX_OPEN:
+            _, old = FILES.popitem(last=False)
+            with old.lock:
+                old.fh.close()
+        return entry
+
+def close_dataset_files():
+    with files_lock:
+        while FILES:
+            _, entry = FILES.popitem()
+            with entry.lock:
+                entry.fh.close()
+
+# batches: list of (session_id, entries, saved_at) collected by DatasetWriter,
+# so each file gets one locked write + flush per flush no matter how many requests fed it
+def append_dataset_lines(fp: Path, fmt: str, batches):
     if fmt == "csv":
-        exists = fp.exists()
-        with fp.open("a", encoding="utf-8", newline="") as f:
-            writer = csv.writer(f)
-            if not exists:
-                writer.writerow(["timestamp","session_id","provider","message","type"])
-            for e in entries:
-                writer.writerow([e["timestamp"], session_id, e["provider"], e["message"], e.get("type","bot")])
+        entry = _dataset_file(fp, False, ["timestamp","session_id","provider","message","type"])
+        with entry.writing():
+            csv.writer(entry.fh).writerows(
+                [e["timestamp"], session_id, e["provider"], e["message"], e.get("type","bot")]
+                for session_id, entries, _ in batches for e in entries
+            )
+            entry.fh.flush()
     else:
         # JSON lines (one object per line)
-        with fp.open("a", encoding="utf-8") as f:
-            for e in entries:
-                obj = {"timestamp": e["timestamp"], "session_id": session_id, "provider": e["provider"], "message": e["message"], "type": e.get("type","bot")}
-                f.write(json.dumps(obj, ensure_ascii=False) + "\n")
-
-def append_dataset_dialog(fp: Path, session_id: str, fmt: str, dialog_list):
-    payload = {"session_id": session_id, "dialog": dialog_list, "saved_at": _now_str()}
+        # orjson emits UTF-8 bytes directly, so the file is written in binary mode
+        entry = _dataset_file(fp, True)
+        with entry.writing():
+            for session_id, entries, _ in batches:
+                for e in entries:
+                    obj = {"timestamp": e["timestamp"], "session_id": session_id, "provider": e["provider"], "message": e["message"], "type": e.get("type","bot")}
+                    entry.fh.write(orjson.dumps(obj) + b"\n")
+            entry.fh.flush()
+
+def append_dataset_dialog(fp: Path, fmt: str, batches):
     if fmt == "csv":
         # store the whole dialog as one CSV row (json encoded)
-        exists = fp.exists()
-        with fp.open("a", encoding="utf-8", newline="") as f:
-            writer = csv.writer(f)
-            if not exists:
-                writer.writerow(["session_id","saved_at","dialog_json"])
-            writer.writerow([session_id, payload["saved_at"], json.dumps(dialog_list, ensure_ascii=False)])
+        entry = _dataset_file(fp, False, ["session_id","saved_at","dialog_json"])
+        with entry.writing():
+            csv.writer(entry.fh).writerows(
+                [session_id, saved_at, orjson.dumps(dialog_list).decode("utf-8")]
+                for session_id, dialog_list, saved_at in batches
+            )
+            entry.fh.flush()
     else:
         # JSON: append one object per dialog
-        with fp.open("a", encoding="utf-8") as f:
-            f.write(json.dumps(payload, ensure_ascii=False) + "\n")
+        entry = _dataset_file(fp, True)
+        with entry.writing():
+            for session_id, dialog_list, saved_at in batches:
+                payload = {"session_id": session_id, "dialog": dialog_list, "saved_at": saved_at}
+                entry.fh.write(orjson.dumps(payload) + b"\n")
+            entry.fh.flush()
+
+_STOP = object()  # queue sentinel: flush everything and end the writer thread
+
+class DatasetWriter:
+    # Request threads only enqueue; one daemon thread drains the queue every
+    # `interval` seconds (or once `max_pending` items are waiting) and writes
+    # each (file, format, shape) group in one locked write to its cached handle.
+    # Items the thread has taken off the queue sit in self._pending, which flush()
+    # also writes; close() drains through the thread itself, so nothing is lost at exit.
+    def __init__(self, interval=0.1, max_pending=64):
+        self._q = queue.Queue()
+        self._interval = interval
+        self._max_pending = max_pending
+        self._flush_lock = threading.Lock()
+        self._pending = []
+        self._thread = threading.Thread(target=self._run, name="dataset-writer", daemon=True)
+        self._thread.start()
+
+    def submit(self, fp: Path, fmt: str, session_id: str, entries, shape="lines"):
+        self._q.put((fp, fmt, shape, session_id, entries, _now_str()))
+
+    def _run(self):
+        while True:
+            item = self._q.get()
+            if item is not _STOP:
+                with self._flush_lock:
+                    self._pending.append(item)
+                deadline = time.monotonic() + self._interval
+                while self._q.qsize() < self._max_pending and time.monotonic() < deadline:
+                    time.sleep(0.01)
+            if self.flush():
+                return
+
+    def flush(self):
+        # returns True once the stop sentinel has been seen
+        stop = False
+        with self._flush_lock:
+            pending, self._pending = self._pending, []
+            while True:
+                try:
+                    item = self._q.get_nowait()
+                except queue.Empty:
+                    break
+                if item is _STOP:
+                    stop = True
+                else:
+                    pending.append(item)
+            groups = {}
+            for fp, fmt, shape, session_id, entries, saved_at in pending:
+                groups.setdefault((fp, fmt, shape), []).append((session_id, entries, saved_at))
+            for (fp, fmt, shape), batches in groups.items():
+                try:
+                    if shape == "dialog":
+                        append_dataset_dialog(fp, fmt, batches)
+                    else:
+                        append_dataset_lines(fp, fmt, batches)
+                except Exception as e:
+                    print("[Dataset] write failed:", fp, e)
+        return stop
+
+    def close(self, timeout=5):
+        self._q.put(_STOP)
+        self._thread.join(timeout)
+        self.flush()  # in case the thread was already gone
+
+DATASET_WRITER = DatasetWriter()
+
+@atexit.register
+def _shutdown_datasets():
+    DATASET_WRITER.close()
+    close_dataset_files()
+
+# ---- Prompts ----
+# Prompt-cache contract: every prompt starts with a static, byte-identical guidance block
+# and only the per-request content (user query, brainstorm context) follows it. Providers
+# that cache prompt prefixes can then reuse the guidance tokens across requests. Keep
+# anything dynamic (timestamps, session ids, f-string fields) out of the guidance blocks.
+_ASK_GUIDANCE = (
+    "Please answer clearly. If code is needed include it. Avoid repeating earlier content verbatim. "
+    "If you refer to another bot, name it. Keep replies focused."
+)
+
+_BRAINSTORM_GUIDANCE = (
+    "You are in a multi-bot brainstorming. "
+    "Improve and refine ideas; don't repeat verbatim. "
+    "Be concise but thorough. If code is needed, include it. "
+    "Cite which bot you're responding to when relevant. "
+    "⚙️ Coding Guidelines:"
+    "- Never resend the entire file unless explicitly asked.  "
+    "- Always suggest localized changes:"
+    "  • “Insert below line 120 …”  "
+    "  • “Replace line 85 with …”  "
+    "  • “Add this block before function main()”  "
+    "- If line numbers may differ, use keyword anchors:  "
+    "  • “Insert after the line containing `def clear_history`”.  "
+    "- If multiple edits are required, list them step by step.  "
+    "- Keep diffs small, precise, and easy to apply.  "
+    "🎯 Goal:"
+    "- Collaborate constructively.  "
+    "- Avoid duplication, instead build on each other's points.  "
+    "- Keep memory efficient: no unnecessary repetition.  "
+)
 
 def build_brainstorm_prompt(messages):
-    # messages: list of {"provider": ..., "reply": ...}
-    lines = []
-    for m in messages[-12:]:  # last 12 to keep it manageable
-        prov = m.get("provider","unknown")
-        txt = m.get("reply","").strip()
-        if not txt: continue
-        lines.append(f"{prov}: {txt}")
-    guidance = (
-        "You are in a multi-bot brainstorming. "
-        "Improve and refine ideas; don't repeat verbatim. "
-        "Be concise but thorough. If code is needed, include it. "
-        "Cite which bot you're responding to when relevant. "
-        "⚙️ Coding Guidelines:"
-        "- Never resend the entire file unless explicitly asked.  "
-        "- Always suggest localized changes:"
-        "  • “Insert below line 120 …”  "
-        "  • “Replace line 85 with …”  "
-        "  • “Add this block before function main()”  "
-        "- If line numbers may differ, use keyword anchors:  "
-        "  • “Insert after the line containing `def clear_history`”.  "
-        "- If multiple edits are required, list them step by step.  "
-        "- Keep diffs small, precise, and easy to apply.  "
-        "🎯 Goal:"
-        "- Collaborate constructively.  "
-        "- Avoid duplication, instead build on each other's points.  "
-        "- Keep memory efficient: no unnecessary repetition.  "
-
+    # messages: list of {"provider": ..., "reply": ...}; last 12 to keep it manageable
+    ctx = "\n".join(
+        f"{m.get('provider','unknown')}: {t}"
+        for m in messages[-12:] if (t := m.get("reply","").strip())
     )
-    return guidance + "\n\nContext so far:\n" + "\n".join(lines) + "\n\nYour improved contribution:"
+    # static guidance first, dynamic context last (see prompt-cache contract above)
+    return f"{_BRAINSTORM_GUIDANCE}\n\nContext so far:\n{ctx}\n\nYour improved contribution:"
+
+# One event-loop thread supervises every tgpt process; TGPT_WORKERS caps how many
+# run at once. Concurrent requests served without queueing ~= TGPT_WORKERS / len(GROUP_LIST).
+TGPT_WORKERS = int(os.getenv("TGPT_WORKERS", str((os.cpu_count() or 4) * 5)))
+
+# One event loop for the whole process, running in a daemon thread; request
+# handlers submit coroutines to it instead of paying for asyncio.run() each time.
+# bounded default executor for whatever the loop offloads (asyncio.to_thread, getaddrinfo)
+THREAD_POOL_SIZE = int(os.getenv("THREAD_POOL_SIZE", "32"))
+
+def _start_loop():
+    global LOOP, TGPT_SLOTS
+    LOOP = asyncio.new_event_loop()
+    LOOP.set_default_executor(ThreadPoolExecutor(max_workers=THREAD_POOL_SIZE, thread_name_prefix="asyncio"))
+    threading.Thread(target=LOOP.run_forever, name="asyncio-loop", daemon=True).start()
+    TGPT_SLOTS = asyncio.Semaphore(TGPT_WORKERS)
+
+_start_loop()
+
+def run_async(coro, timeout=TGPT_TIMEOUT + 5):
+    # deadlines are enforced inside the loop; this is only a backstop, and on expiry
+    # the coroutine is cancelled rather than left running unobserved
+    fut = asyncio.run_coroutine_threadsafe(coro, LOOP)
+    try:
+        return fut.result(timeout)
+    except FuturesTimeout:
+        fut.cancel()
+        raise
 
-def run_tgpt(provider: str, prompt: str):
-    # Build command
+async def _spawn_tgpt(provider: str, prompt: str, timeout=TGPT_TIMEOUT):
     # Example: tgpt -w --provider sky "prompt"
-    cmd = [TGPT_BIN, "-w", "--provider", provider, prompt]
+    # returns (text, ok); only ok replies are cached. `timeout` covers the wait for a
+    # TGPT_SLOTS slot as well as the run, and the process is killed if it expires.
+    proc = None
+
+    async def run():
+        nonlocal proc
+        async with TGPT_SLOTS:
+            proc = await asyncio.create_subprocess_exec(
+                TGPT_BIN, "-w", "--provider", provider, prompt,
+                stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE
+            )
+            return await proc.communicate()
+
     try:
-        out = asyncio.run(asyncio.wait_for(asyncio.create_subprocess_exec(
-            *cmd,
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.PIPE
-        ), timeout=TGPT_TIMEOUT))
-        # Gather output
-        async def _collect(proc):
-            stdout, stderr = await proc.communicate()
-            return stdout.decode("utf-8", errors="ignore").strip(), stderr.decode("utf-8", errors="ignore").strip()
-        stdout, stderr = asyncio.run(_collect(out))
-        if stderr and not stdout:
-            return f"[{provider} error] {stderr[:800]}"
-        return stdout or f"[{provider}] (no output)"
+        stdout, stderr = await asyncio.wait_for(run(), timeout)
+    except asyncio.TimeoutError:
+        return f"[{provider} error] timed out after {int(timeout)}s", False
     except Exception as e:
-        return f"[{provider} error] {str(e)}"
-
-# Fallback: thread pool subprocess for compatibility environments
-def run_tgpt_blocking(provider: str, prompt: str):
-    import subprocess
+        return f"[{provider} error] {str(e)}", False
+    finally:
+        if proc is not None and proc.returncode is None:
+            proc.kill()
+            await proc.wait()
+    text = stdout.decode("utf-8", errors="ignore").strip()
+    if not text:
+        err = stderr.decode("utf-8", errors="ignore").strip()
+        return (f"[{provider} error] {err[:800]}" if err else f"[{provider}] (no output)"), False
+    return text, True
+
+# ---- Direct provider HTTP ----
+# Providers with a known HTTP API are called in-process over one pooled keep-alive client
+# (HTTP/2 when h2 is installed) instead of forking tgpt. Any failure, and every provider
+# without a mapping, falls back to the tgpt binary. TGPT_DIRECT=0 turns this off.
+def _pollinations_payload(prompt: str):
+    return {"messages": [{"role": "user", "content": prompt}], "model": "openai"}
+
+# the direct call gets a short whole-call budget so a hung endpoint still leaves
+# time for the tgpt fallback within the same TGPT_TIMEOUT deadline
+DIRECT_TIMEOUT = float(os.getenv("DIRECT_TIMEOUT", "20"))
+
+DIRECT_PROVIDERS = {
+    # provider: (url, payload builder); the response body is the reply text
+    "pollinations": ("https://text.pollinations.ai/", _pollinations_payload),
+}
+
+def _new_http_client():
+    if os.getenv("TGPT_DIRECT", "1") != "1":
+        return None
     try:
-        res = subprocess.run(
-            [TGPT_BIN, "-w", "--provider", provider, prompt],
-            capture_output=True, text=True, timeout=TGPT_TIMEOUT
-        )
-        text = (res.stdout or "").strip()
-        if not text:
-            err = (res.stderr or "").strip()
-            text = f"[{provider} error] {err[:800]}" if err else f"[{provider}] (no output)"
-        return text
+        import httpx
+        try:
+            import h2  # noqa: F401  (enables http2=True)
+            http2 = True
+        except ImportError:
+            http2 = False
+        return httpx.AsyncClient(http2=http2, timeout=DIRECT_TIMEOUT,
+                                 limits=httpx.Limits(max_keepalive_connections=20))
+    except Exception as e:
+        print("[HTTP] Direct provider calls disabled (", e, ")")
+        return None
+
+http_client = _new_http_client()
+
+async def call_provider(provider: str, prompt: str):
+    # returns (text, ok) like _spawn_tgpt; direct call + fallback share one TGPT_TIMEOUT
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + TGPT_TIMEOUT
+    direct = DIRECT_PROVIDERS.get(provider)
+    if direct and http_client is not None:
+        url, body = direct
+        try:
+            # httpx timeouts are per phase; wait_for bounds the whole call
+            r = await asyncio.wait_for(http_client.post(url, json=body(prompt)), DIRECT_TIMEOUT)
+            r.raise_for_status()
+            text = r.text.strip()
+            if text:
+                return text, True
+        except Exception as e:
+            print(f"[HTTP] {provider} direct call failed, using tgpt:", repr(e))
+    remaining = deadline - loop.time()
+    if remaining <= 0:
+        return f"[{provider} error] timed out after {TGPT_TIMEOUT}s", False
+    return await _spawn_tgpt(provider, prompt, remaining)
+
+# ---- Reply cache ----
+# keyed by sha256(provider \0 prompt); optional Redis (REDIS_URL) shares hits across workers
+TGPT_CACHE_TTL = int(os.getenv("TGPT_CACHE_TTL", "3600"))
+TGPT_CACHE = TTLCache(maxsize=2048, ttl=TGPT_CACHE_TTL)
+cache_lock = threading.Lock()
+cache_stats = {"hits": 0, "misses": 0}
+
+REDIS_URL = os.getenv("REDIS_URL", "")
+redis_client = None
+if REDIS_URL:
+    try:
+        import redis.asyncio as aioredis
+        redis_client = aioredis.from_url(REDIS_URL, decode_responses=True)
+        print("[Cache] Redis enabled.")
     except Exception as e:
-        return f"[{provider} error] {str(e)}"
+        print("[Cache] Redis disabled (", e, ")")
+
+def _cache_key(provider: str, prompt: str):
+    return hashlib.sha256(f"{provider}\0{prompt}".encode("utf-8")).hexdigest()
+
+async def run_tgpt(provider: str, prompt: str):
+    key = _cache_key(provider, prompt)
+    with cache_lock:
+        text = TGPT_CACHE.get(key)
+    if text is None and redis_client is not None:
+        try:
+            text = await redis_client.get("tgpt:" + key)
+        except Exception as e:
+            print("[Cache] redis get failed:", e)
+        if text is not None:
+            with cache_lock:
+                TGPT_CACHE[key] = text
+    with cache_lock:
+        cache_stats["hits" if text is not None else "misses"] += 1
+    if text is not None:
+        return text
 
-executor = ThreadPoolExecutor(max_workers=5)
+    text, ok = await call_provider(provider, prompt)
+    if ok:
+        with cache_lock:
+            TGPT_CACHE[key] = text
+        if redis_client is not None:
+            try:
+                await redis_client.setex("tgpt:" + key, TGPT_CACHE_TTL, text)
+            except Exception as e:
+                print("[Cache] redis set failed:", e)
+    return text
 
 async def ask_providers_parallel(providers, prompt: str):
-    loop = asyncio.get_event_loop()
-    tasks = []
-    for p in providers:
-        tasks.append(loop.run_in_executor(executor, run_tgpt_blocking, p, prompt))
+    # each provider gets TGPT_TIMEOUT end to end, so gather always returns in time
+    tasks = [asyncio.wait_for(run_tgpt(p, prompt), TGPT_TIMEOUT) for p in providers]
     results = await asyncio.gather(*tasks, return_exceptions=True)
     out = []
     for p, r in zip(providers, results):
-        if isinstance(r, Exception):
+        if isinstance(r, asyncio.TimeoutError):
+            text = f"[{p} error] timed out after {TGPT_TIMEOUT}s"
+        elif isinstance(r, Exception):
             text = f"[{p} error] {str(r)}"
         else:
             text = str(r)
         out.append({"provider": p, "reply": text, "timestamp": _now_str()})
     return out
 
+_ANSI_RE = re.compile(r"\x1b\[[0-?]*[ -/]*[@-~]")
+
+async def stream_tgpt(provider: str, prompt: str, out: queue.Queue):
+    # push (provider, chunk) onto `out` as tgpt prints lines, then (provider, None).
+    # -q instead of -w: tgpt streams the reply as it arrives, without the spinner.
+    # Same deadline rules as _spawn_tgpt: the TGPT_SLOTS wait counts toward TGPT_TIMEOUT.
+    sent = False
+    proc = None
+
+    async def pump():
+        nonlocal sent
+        async for raw in proc.stdout:
+            line = _ANSI_RE.sub("", raw.decode("utf-8", errors="ignore")).replace("\r", "")
+            if line:
+                out.put((provider, line))
+                sent = True
+
+    async def run():
+        nonlocal proc
+        async with TGPT_SLOTS:
+            proc = await asyncio.create_subprocess_exec(
+                TGPT_BIN, "-q", "--provider", provider, prompt,
+                stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE
+            )
+            # drain both pipes together so a chatty stderr can't stall stdout
+            _, stderr = await asyncio.gather(pump(), proc.stderr.read())
+            await proc.wait()
+            return stderr
+
+    try:
+        stderr = await asyncio.wait_for(run(), TGPT_TIMEOUT)
+        if not sent:
+            err = _ANSI_RE.sub("", stderr.decode("utf-8", errors="ignore")).strip()
+            out.put((provider, f"[{provider} error] {err[:800]}" if err else f"[{provider}] (no output)"))
+    except asyncio.TimeoutError:
+        if not sent:
+            out.put((provider, f"[{provider} error] timed out after {TGPT_TIMEOUT}s"))
+    except Exception as e:
+        if not sent:
+            out.put((provider, f"[{provider} error] {str(e)}"))
+    finally:
+        if proc is not None and proc.returncode is None:
+            proc.kill()
+            await proc.wait()
+        out.put((provider, None))
+
+# ---- Fork safety ----
+# With `gunicorn --preload` this module is imported once in the master and then forked.
+# Threads don't survive fork and pooled DB sockets must not be shared between processes,
+# so every worker starts its own event loop and dataset writer and opens its own DB pool
+# and HTTP client.
+def _after_fork_in_child():
+    global DATASET_WRITER, db_pool, USE_DB, http_client
+    _start_loop()
+    DATASET_WRITER = DatasetWriter()
+    http_client = _new_http_client()
+    if USE_DB:
+        try:
+            db_pool = _new_db_pool()
+        except Exception as e:
+            print("[DB] Disabled in worker (", e, ")")
+            USE_DB = False
+            db_pool = None
+
+os.register_at_fork(after_in_child=_after_fork_in_child)
+
 # ---- Flask ----
+class OrjsonProvider(JSONProvider):
+    # jsonify() and request.get_json() go through orjson
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS).decode("utf-8")
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
 CORS(app)
 
 @app.route("/history", methods=["GET"])
@@ -224,9 +687,8 @@ def ask():
     if not query and "file" not in request.files:
         return jsonify({"error":"empty query"}), 200
 
-    # record user message
-    if query:
-        save_to_db(session_id, "user", query, "user")
+    # user message is recorded together with the replies in one batch
+    db_rows = [("user", query, "user", _now_str())] if query else []
 
     # Provider handling
     if provider == "group":
@@ -236,15 +698,15 @@ def ask():
             return jsonify({"error": f"invalid provider '{provider}'"}), 200
         providers = [provider]
 
-    # Make a concise guidance to avoid flooding
-    guidance = (
-        "Please answer clearly. If code is needed include it. Avoid repeating earlier content verbatim. "
-        "If you refer to another bot, name it. Keep replies focused."
-    )
-    prompt = query if not query else f"{query}\n\n{guidance}"
+    # static guidance first so the prompt prefix is cacheable upstream
+    prompt = query if not query else f"{_ASK_GUIDANCE}\n\nUser:\n{query}"
 
     # Parallel ask
-    replies = asyncio.run(ask_providers_parallel(providers, prompt))
+    try:
+        replies = run_async(ask_providers_parallel(providers, prompt))
+    except FuturesTimeout:
+        save_many_to_db(session_id, db_rows)  # keep the user's query even without replies
+        return jsonify({"error": "providers timed out"}), 504
 
     # Save replies
     entries = []
@@ -252,19 +714,20 @@ def ask():
         provider_name = item["provider"]
         msg = item["reply"]
         ts = item["timestamp"]
-        save_to_db(session_id, provider_name, msg, "bot")
+        db_rows.append((provider_name, msg, "bot", ts))
         entries.append({"provider": provider_name, "message": msg, "timestamp": ts, "type":"bot"})
+    save_many_to_db(session_id, db_rows)
 
     # Dataset save (optional)
     saved = None
     if save_dataset:
         fp = dataset_path(filename, save_format)
         if save_shape == "dialog":
-            # fetch full session dialog (user+bot) for a snapshot
-            dialog = fetch_history(session_id) if USE_DB else entries
-            append_dataset_dialog(fp, session_id, save_format, dialog)
+            # full session dialog (user+bot) for a snapshot, served from memory
+            dialog = session_dialog(session_id) if USE_DB else entries
+            DATASET_WRITER.submit(fp, save_format, session_id, dialog, shape="dialog")
         else:
-            append_dataset_lines(fp, session_id, save_format, entries)
+            DATASET_WRITER.submit(fp, save_format, session_id, entries)
         saved = str(fp)
 
     # If single provider, flatten
@@ -275,12 +738,83 @@ def ask():
 
     return jsonify({"multi": replies, **({"saved_to": saved} if saved else {})})
 
+@app.route("/ask-stream", methods=["GET", "POST"])
+def ask_stream():
+    # Server-Sent Events: one `data: {"provider", "chunk"}` event per tgpt output line,
+    # then `event: done` with the full replies once every provider has finished.
+    session_id = (request.values.get("session_id") or "default").strip()
+    provider = (request.values.get("provider") or "phind").strip()
+    query = (request.values.get("query") or "").strip()
+
+    if not query:
+        return jsonify({"error":"empty query"}), 200
+    if provider == "group":
+        providers = GROUP_LIST
+    else:
+        if provider not in VALID_PROVIDERS:
+            return jsonify({"error": f"invalid provider '{provider}'"}), 200
+        providers = [provider]
+
+    user_ts = _now_str()
+    prompt = f"{_ASK_GUIDANCE}\n\nUser:\n{query}"
+    out = queue.Queue()
+    futures = [asyncio.run_coroutine_threadsafe(stream_tgpt(p, prompt, out), LOOP) for p in providers]
+
+    def generate():
+        chunks = {p: [] for p in providers}
+        saved = False
+
+        def persist():
+            # one batch like /ask; providers that produced nothing yet are left out
+            nonlocal saved
+            saved = True
+            ts = _now_str()
+            replies = [{"provider": p, "reply": "".join(chunks[p]).strip(), "timestamp": ts} for p in providers]
+            save_many_to_db(session_id, [("user", query, "user", user_ts)]
+                            + [(r["provider"], r["reply"], "bot", ts) for r in replies if r["reply"]])
+            return replies
+
+        try:
+            pending = len(providers)
+            while pending:
+                try:
+                    p, chunk = out.get(timeout=TGPT_TIMEOUT + 5)
+                except queue.Empty:
+                    break
+                if chunk is None:
+                    pending -= 1
+                    continue
+                chunks[p].append(chunk)
+                yield f"data: {orjson.dumps({'provider': p, 'chunk': chunk}).decode('utf-8')}\n\n"
+
+            replies = persist()
+            yield f"event: done\ndata: {orjson.dumps({'multi': replies}).decode('utf-8')}\n\n"
+        finally:
+            # client went away (GeneratorExit) or we gave up: stop tgpt so it releases its
+            # TGPT_SLOTS slot (stream_tgpt kills the process), and keep what arrived so far
+            for f in futures:
+                if not f.done():
+                    f.cancel()
+            if not saved:
+                persist()
+
+    return Response(generate(), mimetype="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+@app.route("/cache-stats", methods=["GET"])
+def cache_stats_view():
+    with cache_lock:
+        stats = {**cache_stats, "size": len(TGPT_CACHE), "maxsize": TGPT_CACHE.maxsize, "ttl": TGPT_CACHE_TTL}
+    stats["redis"] = redis_client is not None
+    return jsonify(stats)
+
 @app.route("/clear-history", methods=["POST"])
 def clear_history():
     session_id = request.form.get("session_id")
     try:
-        with db_conn.cursor() as cur:
-            cur.execute("DELETE FROM conversations WHERE session_id = %s", (session_id,))
+        with _dialog_session_lock(session_id):
+            with get_conn() as c, c.cursor() as cur:
+                cur.execute("DELETE FROM conversations WHERE session_id = %s", (session_id,))
+            forget_dialog(session_id)
         return jsonify({"message": "History cleared successfully"})
     except Exception as e:
         return jsonify({"error": str(e)}), 500
@@ -296,35 +830,49 @@ def brainstorm():
     save_shape = (data.get("save_shape") or "lines").strip().lower()
     filename = (data.get("filename") or "").strip()
 
-    # Resolve providers
-    if providers == ["group"] or (len(providers)==1 and providers[0]=="group"):
-        providers = GROUP_LIST
-    else:
-        providers = [p for p in providers if p in VALID_PROVIDERS]
-        if not providers:
-            providers = GROUP_LIST
+    # Resolve providers: "group" expands in place, unknown names are dropped,
+    # duplicates removed keeping first-seen order (["group","sky"] stays 5 calls)
+    # JSON may carry anything here; only strings are looked up (frozenset needs hashable)
+    if isinstance(providers, str):
+        providers = [providers]
+    elif not isinstance(providers, list):
+        providers = []
+    resolved = []
+    for p in providers:
+        if not isinstance(p, str):
+            continue
+        if p == "group":
+            resolved.extend(GROUP_LIST)
+        elif p in VALID_PROVIDERS:
+            resolved.append(p)
+    providers = list(dict.fromkeys(resolved)) or GROUP_LIST
 
     prompt = build_brainstorm_prompt(messages)
 
-    replies = asyncio.run(ask_providers_parallel(providers, prompt))
+    try:
+        replies = run_async(ask_providers_parallel(providers, prompt))
+    except FuturesTimeout:
+        return jsonify({"error": "providers timed out"}), 504
 
     # Save to DB and dataset
     entries = []
+    db_rows = []
     for item in replies:
         provider_name = item["provider"]
         msg = item["reply"]
         ts = item["timestamp"]
-        save_to_db(session_id, provider_name, msg, "brainstorm")
+        db_rows.append((provider_name, msg, "brainstorm", ts))
         entries.append({"provider": provider_name, "message": msg, "timestamp": ts, "type":"brainstorm"})
+    save_many_to_db(session_id, db_rows)
 
     saved = None
     if save_dataset:
         fp = dataset_path(filename, save_format)
         if save_shape == "dialog":
-            dialog = fetch_history(session_id) if USE_DB else entries
-            append_dataset_dialog(fp, session_id, save_format, dialog)
+            dialog = session_dialog(session_id) if USE_DB else entries
+            DATASET_WRITER.submit(fp, save_format, session_id, dialog, shape="dialog")
         else:
-            append_dataset_lines(fp, session_id, save_format, entries)
+            DATASET_WRITER.submit(fp, save_format, session_id, entries)
         saved = str(fp)
 
     return jsonify({"multi": replies, **({"saved_to": saved} if saved else {})})
@@ -332,5 +880,8 @@ def brainstorm():
 if __name__ == "__main__":
     host = os.getenv("HOST", "0.0.0.0")
     port = int(os.getenv("PORT", "8080"))
-    debug = os.getenv("DEBUG", "1") == "1"
+    # development server only; production runs under gunicorn via wsgi.py
+    debug = os.getenv("DEBUG", "0") == "1"
+    # turn SIGTERM into a normal exit so atexit flushes and closes the dataset files
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
     app.run(host=host, port=port, debug=debug)
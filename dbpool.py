@@ -0,0 +1,51 @@
+import queue
+import threading
+from contextlib import contextmanager
+
+import pymysql
+
+# Shared by api.py and irc-AI-Bot.py: a small pool of autocommit PyMySQL
+# connections so concurrent handlers each lease their own socket.
+class DBPool:
+    def __init__(self, min_size=5, max_size=20, timeout=10, **conn_kwargs):
+        conn_kwargs.setdefault("cursorclass", pymysql.cursors.Cursor)
+        conn_kwargs["autocommit"] = True
+        self._kwargs = conn_kwargs
+        self._timeout = timeout
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(max_size)
+        for _ in range(min_size):
+            self._idle.put(self._connect())
+
+    def _connect(self):
+        return pymysql.connect(**self._kwargs)
+
+    def get_conn(self):
+        if not self._slots.acquire(timeout=self._timeout):
+            raise RuntimeError("DB pool exhausted")
+        try:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                return self._connect()
+            # recover connections the server dropped (wait_timeout, restarts)
+            conn.ping(reconnect=True)
+            return conn
+        except Exception:
+            self._slots.release()
+            raise
+
+    def release(self, conn):
+        try:
+            if conn.open:
+                self._idle.put(conn)
+        finally:
+            self._slots.release()
+
+    @contextmanager
+    def connection(self):
+        conn = self.get_conn()
+        try:
+            yield conn
+        finally:
+            self.release(conn)
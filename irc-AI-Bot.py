@@ -1,9 +1,12 @@
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import irc.bot
 import irc.strings
 from irc.client import ip_numstr_to_quad, ip_quad_to_numstr
-import pymysql
 import datetime
+from collections import deque, OrderedDict
+from contextlib import contextmanager
 
 # --- IRC / Bot Config ---
 SERVER = "irc.dal.net"
@@ -20,30 +23,90 @@ DB_USER = "chatuser"
 DB_PASS = "strongpassword"
 DB_NAME = "chatbot"
 
+# Keep-alive connections to the API are reused across IRC messages
+SESSION = requests.Session()
+SESSION.mount("http://", HTTPAdapter(
+    pool_connections=10, pool_maxsize=20,
+    max_retries=Retry(total=2, backoff_factor=0.2, status_forcelist=[502, 503, 504])
+))
+
 # --- Max line length for IRC ---
-IRC_MAX_LINE = 400  # conservative to avoid exceeding 512 bytes
+IRC_MAX_LINE = 400  # bytes per message; conservative to avoid exceeding 512 bytes
 
 # --- Utilities ---
 def now_str():
     return datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
 
-# Connect to DB
+def utf8_chunks(line, limit=IRC_MAX_LINE):
+    # IRC limits are in bytes: split the encoded line, backing off so a cut
+    # never lands on a UTF-8 continuation byte (0b10xxxxxx)
+    b = line.encode("utf-8")
+    if len(b) <= limit:
+        yield line
+        return
+    i, n = 0, len(b)
+    while i < n:
+        j = min(i + limit, n)
+        while j < n and (b[j] & 0xC0) == 0x80:
+            j -= 1
+        yield b[i:j].decode("utf-8")
+        i = j
+
+# Connect to DB (pooled, see dbpool.py)
 try:
-    db_conn = pymysql.connect(
+    from dbpool import DBPool
+    db_pool = DBPool(
+        min_size=1, max_size=4,
         host=DB_HOST, port=DB_PORT, user=DB_USER,
-        password=DB_PASS, database=DB_NAME, autocommit=True
+        password=DB_PASS, database=DB_NAME
     )
     print("[DB] Connected successfully.")
 except Exception as e:
     print("[DB] Connection failed:", e)
-    db_conn = None
+    db_pool = None
+
+if db_pool:
+    # recall_facts is WHERE session_id ORDER BY id DESC: make it a reverse index scan
+    try:
+        with db_pool.connection() as c, c.cursor() as cur:
+            cur.execute("CREATE INDEX IF NOT EXISTS idx_memory_sess_id ON memory (session_id, id DESC)")
+    except Exception as e:
+        print("[DB] memory index error:", e)
+
+@contextmanager
+def get_conn():
+    with db_pool.connection() as conn:
+        yield conn
 
 # --- Memory helpers ---
+MEMORY_CONTEXT = 12  # facts sent along with each query
+
+MEMORY_NICKS = 512    # nicks kept in recent_facts, least recently active dropped first
+
+# nick -> deque of the most recent facts (oldest first); filled from the DB once per nick
+# and kept current by save_fact, so the per-message path doesn't query MySQL
+recent_facts = OrderedDict()
+
+def recent_memory(session_id):
+    facts = recent_facts.get(session_id)
+    if facts is not None:
+        recent_facts.move_to_end(session_id)
+        return facts
+    rows = recall_facts(session_id, MEMORY_CONTEXT)
+    if rows is None:
+        return []  # DB error: don't cache, try again on the next message
+    facts = recent_facts[session_id] = deque(reversed(rows), maxlen=MEMORY_CONTEXT)
+    while len(recent_facts) > MEMORY_NICKS:
+        recent_facts.popitem(last=False)
+    return facts
+
 def save_fact(session_id, provider, message, mtype="bot"):
-    if not db_conn:
+    if session_id in recent_facts:
+        recent_facts[session_id].append({"provider": provider, "message": message})
+    if not db_pool:
         return
     try:
-        with db_conn.cursor() as cur:
+        with get_conn() as c, c.cursor() as cur:
             cur.execute(
                 "INSERT INTO memory (session_id, provider, message, type, timestamp) "
                 "VALUES (%s,%s,%s,%s,%s)",
@@ -53,18 +116,19 @@ def save_fact(session_id, provider, message, mtype="bot"):
         print("[DB] save_fact error:", e)
 
 def recall_facts(session_id, limit=50):
-    if not db_conn:
+    if not db_pool:
         return []
     try:
-        with db_conn.cursor() as cur:
+        with get_conn() as c, c.cursor() as cur:
             cur.execute(
                 "SELECT provider, message FROM memory WHERE session_id=%s "
                 "ORDER BY id DESC LIMIT %s", (session_id, limit)
             )
             return [{"provider": r[0], "message": r[1]} for r in cur.fetchall()]
     except Exception as e:
+        # None (not []) so callers can tell a failed read from an empty memory
         print("[DB] recall_fact error:", e)
-        return []
+        return None
 
 # --- IRC Bot ---
 class SkyBot(irc.bot.SingleServerIRCBot):
@@ -89,8 +153,8 @@ class SkyBot(irc.bot.SingleServerIRCBot):
     def handle_message(self, c, target, nick, user_msg):
         try:
             # Recall memory and append to message if needed
-            past_facts = recall_facts(nick)
-            memory_context = "\n".join([f"{f['provider']}: {f['message']}" for f in past_facts[-12:]])
+            past_facts = recent_memory(nick)
+            memory_context = "\n".join(f"{f['provider']}: {f['message']}" for f in past_facts)
             full_query = f"{user_msg}\n\nMemory context:\n{memory_context}" if memory_context else user_msg
 
             payload = {
@@ -99,7 +163,7 @@ class SkyBot(irc.bot.SingleServerIRCBot):
                 "query": full_query
             }
             print("[DEBUG] Sending payload to API:", payload)
-            r = requests.post(API_URL, data=payload, timeout=60)
+            r = SESSION.post(API_URL, data=payload, timeout=60)
             print("[DEBUG] API status:", r.status_code)
             print("[DEBUG] API raw response:", r.text)
 
@@ -108,12 +172,12 @@ class SkyBot(irc.bot.SingleServerIRCBot):
                 reply = data.get("reply") or data.get("message") or ""
                 if reply:
                     save_fact(nick, "sky", reply)
-                    # Split multi-line messages to avoid carriage return issues
-                    lines = reply.replace("\r","").split("\n")
-                    for line in lines:
-                        for chunk_start in range(0, len(line), IRC_MAX_LINE):
-                            chunk = line[chunk_start:chunk_start+IRC_MAX_LINE]
-                            c.privmsg(target, chunk)
+                    # Split multi-line messages to avoid carriage return issues; one
+                    # PRIVMSG per chunk (send_raw rejects embedded newlines)
+                    chunks = [chunk for line in reply.replace("\r","").split("\n") if line
+                              for chunk in utf8_chunks(line)]
+                    for chunk in chunks:
+                        c.privmsg(target, chunk)
                 else:
                     c.privmsg(target, "No reply from API.")
             else:
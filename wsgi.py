@@ -0,0 +1,15 @@
+# WSGI entry point for production:
+#
+#   gunicorn -w $((2*$(nproc)+1)) -k gthread --threads 8 --preload -b 0.0.0.0:8080 wsgi:application
+#
+# --preload imports api.py once in the master; each forked worker then opens its
+# own DB pool and restarts the event loop / dataset writer threads (see api.py,
+# "Fork safety"). Each worker serves up to --threads requests at a time.
+#
+# The in-memory dialog cache only sees its own worker's inserts, so it is off here
+# unless DIALOG_CACHE=1 is set explicitly (safe with -w 1 only).
+import os
+
+os.environ.setdefault("DIALOG_CACHE", "0")
+
+from api import app as application